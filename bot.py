@@ -1,26 +1,58 @@
 #!/usr/bin/env python3
+import asyncio
+import atexit
 import logging
-import psycopg2
-from datetime import datetime
+import logging.handlers
+import queue
+import re
+import signal
+import time
+import asyncpg
+from collections import Counter, OrderedDict
+from datetime import date
+from html import escape
 from aiogram import Bot, Dispatcher, types
 from aiogram import executor
 from dotenv import load_dotenv
 import os
 
-# Настройка логирования
+# Загрузка переменных окружения
+load_dotenv()
+
+def env_flag(name):
+    """Читает логический флаг из окружения: 1/true/yes/on включают его"""
+    return os.getenv(name, '').strip().lower() in ('1', 'true', 'yes', 'on')
+
+# Настройка логирования: обработчики пишут только в очередь, а запись
+# в консоль (и в bot.log при BOT_LOG_TO_FILE) выполняет QueueListener
+# в отдельном потоке. По умолчанию пишем только в stderr: ротацией
+# занимаются journald или docker logs
+_log_formatter = logging.Formatter(
+    '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+_log_handlers = [logging.StreamHandler()]
+if env_flag('BOT_LOG_TO_FILE'):
+    _log_handlers.append(logging.FileHandler('bot.log'))
+for _handler in _log_handlers:
+    _handler.setFormatter(_log_formatter)
+
+_log_queue = queue.SimpleQueue()
+log_listener = logging.handlers.QueueListener(
+    _log_queue, *_log_handlers, respect_handler_level=True
+)
+# QueueHandler кладёт в очередь уже отформатированный текст, поэтому
+# префикс с датой и уровнем добавляют только конечные обработчики
 logging.basicConfig(
     level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('bot.log'),
-        logging.StreamHandler()
-    ]
+    format='%(message)s',
+    handlers=[logging.handlers.QueueHandler(_log_queue)]
 )
+log_listener.start()
+# Останавливаем слушатель только при выходе из процесса, чтобы
+# дописать и сообщения, которые aiogram логирует после on_shutdown
+atexit.register(log_listener.stop)
 logger = logging.getLogger(__name__)
 
-# Загрузка переменных окружения
-load_dotenv()
-
 # Конфигурация
 API_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
 if not API_TOKEN:
@@ -29,185 +61,492 @@ if not API_TOKEN:
 
 # Конфигурация PostgreSQL
 DB_CONFIG = {
-    "dbname": os.getenv('DB_NAME', 'thanks_bot_db'),
+    "database": os.getenv('DB_NAME', 'thanks_bot_db'),
     "user": os.getenv('DB_USER', 'bot_user'),
     "password": os.getenv('DB_PASSWORD', 'secure_password'),
     "host": os.getenv('DB_HOST', 'localhost')
 }
 
-# Инициализация бота
-bot = Bot(token=API_TOKEN)
+# Конфигурация webhook. Без WEBHOOK_URL бот работает через long polling
+WEBHOOK_URL = (os.getenv('WEBHOOK_URL') or '').rstrip('/')
+WEBHOOK_PATH = f'/tg/{API_TOKEN}'
+WEBAPP_HOST = os.getenv('WEBAPP_HOST', '0.0.0.0')
+WEBAPP_PORT = int(os.getenv('PORT', 8080))
+
+# Отладочный режим: запись в БД до ответа пользователю, минуя очередь,
+# чтобы ошибки базы сразу были видны в чате
+SYNC_DB_WRITES = env_flag('BOT_SYNC_DB_WRITES')
+
+# Колонки thanks_messages, заполняемые пачкой через COPY
+MESSAGE_COLUMNS = [
+    'sender_id', 'sender_username', 'recipient_username',
+    'message_text', 'message_date'
+]
+
+# SQL-запросы горячего пути. Текст запросов неизменен, поэтому asyncpg
+# готовит их один раз на соединение и дальше берёт из кэша выражений.
+# Счётчики для /stats обновляются вместе со вставкой сообщений,
+# чтобы статистика не требовала полного прохода по thanks_messages
+INCREMENT_RECIPIENT_SQL = """
+    INSERT INTO recipient_counts (recipient_username, cnt)
+    VALUES ($1, $2)
+    ON CONFLICT (recipient_username)
+    DO UPDATE SET cnt = recipient_counts.cnt + EXCLUDED.cnt
+"""
+
+INCREMENT_TOTAL_SQL = "UPDATE thanks_total SET cnt = cnt + $1 WHERE id = 1"
+
+TOTAL_SQL = "SELECT cnt FROM thanks_total WHERE id = 1"
+
+TOP5_SQL = """
+    SELECT recipient_username, cnt 
+    FROM recipient_counts 
+    ORDER BY cnt DESC 
+    LIMIT 5
+"""
+
+# Ответ на /start и /help
+_WELCOME_HTML = (
+    "👋 Привет! Я бот для отправки благодарностей.\n\n"
+    "Просто напиши мне в формате:\n"
+    "<code>@username текст_благодарности</code>\n\n"
+    "Пример:\n"
+    "<code>@kolya спасибо за помощь с проектом!</code>\n\n"
+    "Все сообщения сохраняются в нашу базу благодарностей 💾"
+)
+
+# Подтверждение приёма. Пользовательский ввод подставляется только
+# после html.escape, иначе Telegram отклонит разметку
+_ACK_TMPL = (
+    "✅ Сообщение принято!\n\n"
+    "👤 Кому: <code>{u}</code>\n"
+    "📝 Текст: <code>{t}</code>\n"
+    "📅 Дата: <code>{d}</code>"
+)
+
+# Формат сообщения: "@username текст благодарности"
+_MSG_RE = re.compile(r'^\s*(@\S+)\s+(\S.*?)\s*$', re.DOTALL)
+
+# Длина recipient_username в БД (VARCHAR(100))
+_MAX_USERNAME_LEN = 100
+
+# Очередь записи в БД (bot['write_q']): сообщения копятся и записываются
+# пачками фоновой задачей. Между ответом пользователю и коммитом есть окно
+# около _WRITE_BATCH_DELAY секунд, в котором данные живут только в памяти
+# и пропадут при аварийном завершении процесса. При сбое соединения пачка
+# повторяется целиком, пока не запишется (at-least-once), с паузой от
+# _WRITE_RETRY_DELAY до _WRITE_MAX_RETRY_DELAY секунд; пока база
+# недоступна, очередь заполняется и новые сообщения получают отказ.
+# Если база отвергает данные, пачка пишется по одной записи, а плохие
+# записи отбрасываются.
+_WRITE_BATCH_SIZE = 500
+_WRITE_BATCH_DELAY = 0.05
+_WRITE_RETRY_DELAY = 1
+_WRITE_MAX_RETRY_DELAY = 30
+_WRITE_QUEUE_MAX_SIZE = 10000
+_DATA_ERRORS = (asyncpg.DataError, asyncpg.IntegrityConstraintViolationError)
+
+# Недавние благодарности для отсечения повторов:
+# (sender_id, recipient, hash(text)) -> время отправки, в порядке LRU
+_DEDUP_TTL = 60
+_DEDUP_MAX_SIZE = 10000
+_recent_thanks = OrderedDict()
+
+# Кэш ответа /stats: готовый текст держим в памяти _STATS_TTL секунд,
+# обновление защищено блокировкой bot['stats_lock']
+_STATS_TTL = 30
+_stats_cache = {"value": None, "expires": 0.0}
+
+# Инициализация бота. Все запросы к Telegram идут через одну
+# aiohttp-сессию бота с keep-alive соединениями. connections_limit
+# ограничивает число одновременных сокетов (по умолчанию без ограничения).
+# aiogram 2 создаёт TCPConnector сам из _connector_init, поэтому время
+# жизни простаивающих соединений и кэш DNS задаём там до создания сессии
+bot = Bot(token=API_TOKEN, connections_limit=100)
+bot._connector_init.update(keepalive_timeout=75, ttl_dns_cache=300)
 dp = Dispatcher(bot)
 
+# Кэш строки с текущей датой: [секунда, строка]
+_date_cache = [0, ""]
+
+def today_str():
+    """Текущая дата в формате ДД-ММ-ГГГГ, пересчитывается раз в секунду"""
+    t = int(time.time())
+    if t != _date_cache[0]:
+        _date_cache[:] = [t, date.today().strftime('%d-%m-%Y')]
+    return _date_cache[1]
+
+def is_duplicate(key):
+    """Проверяет, отправлялась ли такая благодарность за последние _DEDUP_TTL секунд"""
+    sent_at = _recent_thanks.get(key)
+    if sent_at is not None and time.monotonic() - sent_at < _DEDUP_TTL:
+        _recent_thanks.move_to_end(key)
+        return True
+    return False
+
+def remember_thanks(key):
+    """Запоминает успешно принятую благодарность для отсечения повторов"""
+    _recent_thanks[key] = time.monotonic()
+    _recent_thanks.move_to_end(key)
+    if len(_recent_thanks) > _DEDUP_MAX_SIZE:
+        _recent_thanks.popitem(last=False)
+
 async def init_db():
     """Инициализация таблиц в базе данных"""
     try:
-        conn = psycopg2.connect(**DB_CONFIG)
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS thanks_messages (
-                id SERIAL PRIMARY KEY,
-                sender_id BIGINT NOT NULL,
-                sender_username VARCHAR(100),
-                recipient_username VARCHAR(100) NOT NULL,
-                message_text TEXT NOT NULL,
-                message_date DATE NOT NULL DEFAULT CURRENT_DATE,
-                created_at TIMESTAMP NOT NULL DEFAULT NOW()
-            )
-        """)
-        
-        cursor.execute("""
-            CREATE INDEX IF NOT EXISTS idx_message_date 
-            ON thanks_messages(message_date)
-        """)
-        
-        cursor.execute("""
-            CREATE INDEX IF NOT EXISTS idx_recipient 
-            ON thanks_messages(recipient_username)
-        """)
+        async with bot['db'].acquire() as conn:
+            # Схема создаётся одним запросом без параметров: asyncpg
+            # выполняет такую строку за один сетевой обмен
+            await conn.execute("""
+                CREATE TABLE IF NOT EXISTS thanks_messages (
+                    id SERIAL PRIMARY KEY,
+                    sender_id BIGINT NOT NULL,
+                    sender_username VARCHAR(100),
+                    recipient_username VARCHAR(100) NOT NULL,
+                    message_text TEXT NOT NULL,
+                    message_date DATE NOT NULL DEFAULT CURRENT_DATE,
+                    created_at TIMESTAMP NOT NULL DEFAULT NOW()
+                );
+                
+                -- Таблица пополняется только в конец, поэтому для даты
+                -- хватает компактного BRIN вместо btree
+                DROP INDEX IF EXISTS idx_message_date;
+                CREATE INDEX IF NOT EXISTS idx_message_date_brin 
+                ON thanks_messages USING brin (message_date)
+                WITH (pages_per_range = 32);
+                
+                CREATE INDEX IF NOT EXISTS idx_recipient 
+                ON thanks_messages(recipient_username);
+                
+                CREATE TABLE IF NOT EXISTS recipient_counts (
+                    recipient_username VARCHAR(100) PRIMARY KEY,
+                    cnt BIGINT NOT NULL DEFAULT 0
+                );
+                
+                CREATE INDEX IF NOT EXISTS idx_rc_cnt 
+                ON recipient_counts(cnt DESC);
+                
+                CREATE TABLE IF NOT EXISTS thanks_total (
+                    id INT PRIMARY KEY DEFAULT 1,
+                    cnt BIGINT NOT NULL DEFAULT 0
+                );
+                
+                ANALYZE thanks_messages;
+            """)
+            
+            # При первом запуске заполняем счётчики по уже накопленным данным
+            async with conn.transaction():
+                status = await conn.execute("""
+                    INSERT INTO thanks_total (id, cnt)
+                    SELECT 1, COUNT(*) FROM thanks_messages
+                    ON CONFLICT (id) DO NOTHING
+                """)
+                if status == "INSERT 0 1":
+                    await conn.execute("""
+                        INSERT INTO recipient_counts (recipient_username, cnt)
+                        SELECT recipient_username, COUNT(*)
+                        FROM thanks_messages
+                        GROUP BY recipient_username
+                        ON CONFLICT (recipient_username)
+                        DO UPDATE SET cnt = EXCLUDED.cnt
+                    """)
         
-        conn.commit()
         logger.info("База данных инициализирована")
     except Exception as e:
-        logger.error(f"Ошибка при инициализации БД: {e}")
+        logger.error("Ошибка при инициализации БД: %s", e)
         raise
-    finally:
-        if conn:
-            conn.close()
 
 async def save_to_db(message: types.Message, recipient: str, text: str):
-    """Сохранение сообщения в базу данных"""
+    """Сохранение сообщения в базу данных.
+
+    Обычно запись только ставится в очередь фоновой задачи и ответ
+    пользователю не ждёт коммита. При BOT_SYNC_DB_WRITES=1, а также
+    во время остановки бота, когда очередь уже дописывается, запись
+    выполняется сразу.
+    """
+    record = (
+        message.from_user.id,
+        message.from_user.username,
+        recipient,
+        text,
+        date.today()
+    )
+    
+    if not SYNC_DB_WRITES and not bot.get('stopping'):
+        try:
+            bot['write_q'].put_nowait(record)
+        except asyncio.QueueFull:
+            logger.error("Очередь записи в БД переполнена")
+            return False
+        return True
+    
+    # Обработчики webhook могут доработать уже после закрытия пула
+    pool = bot.get('db')
+    if pool is None or pool.is_closing():
+        logger.error("Сообщение не сохранено: бот останавливается")
+        return False
+    
     try:
-        conn = psycopg2.connect(**DB_CONFIG)
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            INSERT INTO thanks_messages 
-            (sender_id, sender_username, recipient_username, message_text, message_date)
-            VALUES (%s, %s, %s, %s, %s)
-            RETURNING id
-        """, (
-            message.from_user.id,
-            message.from_user.username,
-            recipient,
-            text,
-            datetime.now().strftime('%d-%m-%Y')
-        ))
-        
-        message_id = cursor.fetchone()[0]
-        conn.commit()
-        logger.info(f"Сообщение #{message_id} сохранено в БД")
+        await _flush_batch([record])
         return True
     except Exception as e:
-        logger.error(f"Ошибка при сохранении в БД: {e}")
+        logger.error("Ошибка при сохранении в БД: %s", e)
         return False
-    finally:
-        if conn:
-            conn.close()
 
-@dp.message_handler(commands=['start', 'help'])
+async def _collect_batch():
+    """Собирает пачку записей из очереди. None в пачке означает остановку"""
+    loop = asyncio.get_running_loop()
+    write_q = bot['write_q']
+    batch = [await write_q.get()]
+    deadline = loop.time() + _WRITE_BATCH_DELAY
+    
+    while batch[-1] is not None and len(batch) < _WRITE_BATCH_SIZE:
+        timeout = deadline - loop.time()
+        if timeout <= 0:
+            break
+        try:
+            batch.append(await asyncio.wait_for(write_q.get(), timeout))
+        except asyncio.TimeoutError:
+            break
+    
+    return batch
+
+async def _flush_batch(records):
+    """Записывает пачку сообщений и обновляет счётчики одной транзакцией"""
+    counts = Counter(record[2] for record in records)
+    
+    async with bot['db'].acquire() as conn:
+        async with conn.transaction():
+            await conn.copy_records_to_table(
+                'thanks_messages',
+                records=records,
+                columns=MESSAGE_COLUMNS
+            )
+            await conn.executemany(INCREMENT_RECIPIENT_SQL, counts.items())
+            await conn.execute(INCREMENT_TOTAL_SQL, len(records))
+    
+    logger.info("Сохранено в БД сообщений: %d", len(records))
+
+async def _write_batch(records):
+    """Записывает пачку с повторами при сбоях и отбрасыванием плохих записей"""
+    delay = _WRITE_RETRY_DELAY
+    while True:
+        try:
+            await _flush_batch(records)
+            return
+        except _DATA_ERRORS as e:
+            if len(records) == 1:
+                logger.error("Сообщение отброшено, БД отвергла запись: %s", e)
+                return
+            # Ищем плохую запись, сохраняя остальные по одной
+            for record in records:
+                await _write_batch([record])
+            return
+        except Exception as e:
+            logger.error(
+                "Ошибка при сохранении в БД, повтор через %d с: %s", delay, e
+            )
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, _WRITE_MAX_RETRY_DELAY)
+
+async def _writer_loop():
+    """Фоновая задача записи сообщений из очереди в базу данных"""
+    running = True
+    while running:
+        batch = await _collect_batch()
+        if batch[-1] is None:
+            batch.pop()
+            running = False
+        
+        if batch:
+            await _write_batch(batch)
+
+def _start_writer():
+    """Запускает фоновую задачу записи и следит за её падением"""
+    task = asyncio.create_task(_writer_loop())
+    task.add_done_callback(_on_writer_done)
+    bot['writer'] = task
+
+def _on_writer_done(task):
+    """Логирует падение фоновой задачи записи и перезапускает её"""
+    if task.cancelled() or task.exception() is None:
+        return
+    logger.error("Фоновая запись в БД остановилась с ошибкой",
+                 exc_info=task.exception())
+    if not bot.get('stopping'):
+        _start_writer()
+
+@dp.message_handler(commands=['start', 'help'], commands_prefix='/',
+                    content_types=types.ContentTypes.TEXT)
 async def send_welcome(message: types.Message):
     """Обработка команд /start и /help"""
     try:
-        await message.reply(
-            "👋 Привет! Я бот для отправки благодарностей.\n\n"
-            "Просто напиши мне в формате:\n"
-            "<code>@username текст_благодарности</code>\n\n"
-            "Пример:\n"
-            "<code>@kolya спасибо за помощь с проектом!</code>\n\n"
-            "Все сообщения сохраняются в нашу базу благодарностей 💾",
-            parse_mode='HTML'
-        )
+        await message.reply(_WELCOME_HTML, parse_mode='HTML')
     except Exception as e:
-        logger.error(f"Ошибка в send_welcome: {e}")
+        logger.error("Ошибка в send_welcome: %s", e)
+
+async def build_stats_text():
+    """Формирует текст статистики благодарностей"""
+    # Общее количество и топ-5 получателей независимы, поэтому
+    # запрашиваем их параллельно на двух соединениях пула
+    total, rows = await asyncio.gather(
+        bot['db'].fetchval(TOTAL_SQL),
+        bot['db'].fetch(TOP5_SQL)
+    )
+    top_recipients = "\n".join(
+        [f"{escape(row[0])} - {row[1]}" for row in rows]
+    )
+    
+    return (
+        f"📊 Статистика благодарностей:\n\n"
+        f"Всего сообщений: {total}\n\n"
+        f"Топ-5 получателей:\n{top_recipients}"
+    )
 
 @dp.message_handler(commands=['stats'])
 async def show_stats(message: types.Message):
     """Показывает статистику благодарностей"""
     try:
-        conn = psycopg2.connect(**DB_CONFIG)
-        cursor = conn.cursor()
-        
-        # Получаем общее количество сообщений
-        cursor.execute("SELECT COUNT(*) FROM thanks_messages")
-        total = cursor.fetchone()[0]
+        if time.monotonic() >= _stats_cache["expires"]:
+            async with bot['stats_lock']:
+                # Пока ждали блокировку, кэш мог обновить другой запрос
+                if time.monotonic() >= _stats_cache["expires"]:
+                    _stats_cache["value"] = await build_stats_text()
+                    _stats_cache["expires"] = time.monotonic() + _STATS_TTL
         
-        # Получаем топ-5 получателей
-        cursor.execute("""
-            SELECT recipient_username, COUNT(*) as cnt 
-            FROM thanks_messages 
-            GROUP BY recipient_username 
-            ORDER BY cnt DESC 
-            LIMIT 5
-        """)
-        top_recipients = "\n".join(
-            [f"{row[0]} - {row[1]}" for row in cursor.fetchall()]
-        )
-        
-        await message.reply(
-            f"📊 Статистика благодарностей:\n\n"
-            f"Всего сообщений: {total}\n\n"
-            f"Топ-5 получателей:\n{top_recipients}",
-            parse_mode='HTML'
-        )
+        await message.reply(_stats_cache["value"], parse_mode='HTML')
     except Exception as e:
-        logger.error(f"Ошибка при получении статистики: {e}")
+        logger.error("Ошибка при получении статистики: %s", e)
         await message.reply("⚠️ Не удалось получить статистику")
-    finally:
-        if conn:
-            conn.close()
 
-@dp.message_handler()
+# Сообщения без @username в начале отсекаются фильтром диспетчера
+@dp.message_handler(content_types=types.ContentTypes.TEXT, regexp=r'^\s*@')
 async def process_message(message: types.Message):
     """Обработка текстовых сообщений"""
     try:
-        text = message.text.strip()
+        text = message.text
+        if not text:
+            return
         
-        # Разделяем текст на части
-        parts = text.split(maxsplit=1)
+        # Проверяем формат и разделяем текст на @username и сообщение
+        match = _MSG_RE.match(text)
         
-        if len(parts) < 2:
+        if not match:
             await message.reply("ℹ️ Пожалуйста, укажите @username и сообщение")
             return
         
-        username, user_message = parts
-        username = username.strip()
-        user_message = user_message.strip()
+        username, user_message = match.group(1), match.group(2)
         
-        # Проверяем, что username начинается с @
-        if not username.startswith('@'):
-            await message.reply("❌ Первым словом должен быть @username")
+        if len(username) > _MAX_USERNAME_LEN:
+            await message.reply("❌ Слишком длинный @username")
+            return
+        
+        # Повтор той же благодарности не сохраняем
+        dedup_key = (message.from_user.id, username, hash(user_message))
+        if is_duplicate(dedup_key):
+            await message.reply("ℹ️ Это сообщение уже отправлено")
             return
         
         # Сохраняем в базу данных
         success = await save_to_db(message, username, user_message)
         
         if success:
+            remember_thanks(dedup_key)
             await message.reply(
-                f"✅ Сообщение принято!\n\n"
-                f"👤 Кому: <code>{username}</code>\n"
-                f"📝 Текст: <code>{user_message}</code>\n"
-                f"📅 Дата: <code>{datetime.now().strftime('%d-%m-%Y')}</code>",
+                _ACK_TMPL.format(
+                    u=escape(username),
+                    t=escape(user_message),
+                    d=today_str()
+                ),
                 parse_mode='HTML'
             )
         else:
             await message.reply("⚠️ Сообщение не сохранено. Ошибка базы данных")
             
     except Exception as e:
-        logger.error(f"Ошибка при обработке сообщения: {e}")
+        logger.error("Ошибка при обработке сообщения: %s", e)
         await message.reply("⚠️ Произошла ошибка при обработке вашего сообщения")
 
 async def on_startup(dp):
     """Действия при запуске бота"""
     logger.info("Бот запускается...")
+    # Примитивы asyncio создаём здесь, уже внутри рабочего цикла событий:
+    # на Python < 3.10 они привязываются к циклу в момент создания
+    bot['write_q'] = asyncio.Queue(maxsize=_WRITE_QUEUE_MAX_SIZE)
+    bot['stats_lock'] = asyncio.Lock()
+    bot['db'] = await asyncpg.create_pool(min_size=2, max_size=10, **DB_CONFIG)
     await init_db()
+    _start_writer()
+    if WEBHOOK_URL:
+        await bot.set_webhook(WEBHOOK_URL + WEBHOOK_PATH)
     logger.info("Бот готов к работе!")
 
+async def on_shutdown(dp):
+    """Действия при остановке бота"""
+    logger.info("Бот останавливается...")
+    # С этого момента save_to_db пишет в БД напрямую, минуя очередь,
+    # поэтому после остановки фоновой записи в очередь ничего не попадёт.
+    # Ждать завершения long polling не нужно: getUpdates может висеть
+    # до 20 секунд
+    bot['stopping'] = True
+    if dp.is_polling():
+        dp.stop_polling()
+    
+    # Дописываем всё, что осталось в очереди, и только потом закрываем пул.
+    # В режиме webhook aiohttp вызывает on_shutdown до завершения текущих
+    # запросов; такие обработчики уже не трогают очередь, а пишут напрямую
+    # или, после закрытия пула, отвечают пользователю об ошибке
+    write_q = bot.get('write_q')
+    writer = bot.get('writer')
+    if writer is not None and not writer.done():
+        await write_q.put(None)
+        # Ошибку задачи уже залогировал _on_writer_done, а остаток
+        # очереди дописывается ниже
+        await asyncio.gather(writer, return_exceptions=True)
+    
+    pool = bot.get('db')
+    if pool is not None:
+        leftover = []
+        while write_q is not None and not write_q.empty():
+            record = write_q.get_nowait()
+            if record is not None:
+                leftover.append(record)
+        if leftover:
+            await _write_batch(leftover)
+        await pool.close()
+    logger.info("Бот остановлен")
+
+def _on_sigterm(signum, frame):
+    """SIGTERM (systemd, docker stop) завершает бота так же, как Ctrl+C"""
+    raise KeyboardInterrupt
+
 if __name__ == '__main__':
     logger.info("Запуск бота...")
-    executor.start_polling(
-        dp, 
-        skip_updates=True,
-        on_startup=on_startup
-    )
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        logger.info("uvloop не установлен, используется стандартный цикл asyncio")
+    if WEBHOOK_URL:
+        # Telegram сам присылает обновления; HTTPS обеспечивает
+        # обратный прокси (nginx, Caddy) перед WEBAPP_HOST:WEBAPP_PORT
+        executor.start_webhook(
+            dp,
+            webhook_path=WEBHOOK_PATH,
+            skip_updates=True,
+            on_startup=on_startup,
+            on_shutdown=on_shutdown,
+            host=WEBAPP_HOST,
+            port=WEBAPP_PORT,
+            # Путь содержит токен бота, поэтому access-лог aiohttp выключен
+            access_log=None
+        )
+    else:
+        # В режиме webhook SIGTERM обрабатывает aiohttp
+        signal.signal(signal.SIGTERM, _on_sigterm)
+        executor.start_polling(
+            dp, 
+            skip_updates=True,
+            on_startup=on_startup,
+            on_shutdown=on_shutdown
+        )